@@ -1,17 +1,49 @@
 ﻿import os
 import sys
-import re
 import json
-import glob
+import subprocess
+import tempfile
+import threading
 import traceback
-from typing import Dict, Optional
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+# The patterns here are linear-time (no backrefs/lookaround), so RE2's DFA
+# is a drop-in when available; pyre2 itself falls back per-pattern if not.
+try:
+    import re2 as re
+except ImportError:
+    import re
+
+# orjson serializes in C; stdlib json is the fallback.
+try:
+    import orjson
+
+    def _dumps(obj) -> str:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2).decode()
+except ImportError:
+    def _dumps(obj) -> str:
+        return json.dumps(obj, indent=2, ensure_ascii=False)
 
 import cv2
+import numpy as np
 import pytesseract
 import psycopg2
-from psycopg2.extras import Json
+from psycopg2.extras import Json, execute_values
 from dotenv import load_dotenv
-from PIL import Image
+
+_KV_RE = re.compile(r'^\s*([A-Za-z0-9 _\-/\.]+)\s*[:=]\s*(.+?)\s*$', re.M)
+# Emails and phones share one alternation pass; the kv scan stays
+# separate because contact info mostly appears inside key: value lines,
+# which a fused kv branch would swallow whole.
+_CONTACT_RE = re.compile(
+    r'(?P<email>[A-Za-z0-9._%+\-]+@[A-Za-z0-9.\-]+\.[A-Za-z]{2,})'
+    r'|(?P<phone>(?:\+?\d{1,3}[\s\-\.]?)?(?:\(?\d{2,4}\)?[\s\-\.]?)?\d{3,4}[\s\-\.]?\d{4})',
+)
+_KEY_CLEAN = re.compile(r'[^a-z0-9_]+')
+_NONDIGIT = re.compile(r'\D')
+
+IMAGE_EXTS = {'.png', '.jpg', '.jpeg', '.tif', '.tiff', '.bmp', '.webp'}
 
 
 def load_env():
@@ -38,7 +70,8 @@ def connect_db(pg_cfg):
         user=pg_cfg["user"],
         password=pg_cfg["password"],
     )
-    conn.autocommit = True
+    # Inserts are batched into explicit transactions; see insert_documents.
+    conn.autocommit = False
     return conn
 
 
@@ -54,50 +87,146 @@ def ensure_table(conn):
     '''
     with conn.cursor() as cur:
         cur.execute(ddl)
+        # Session-scoped prepared statement for the single-row insert path;
+        # saves Postgres the parse+plan cost on every row.
+        cur.execute(
+            "PREPARE ocr_ins AS "
+            "INSERT INTO ocr_documents (filename, raw_text, fields) "
+            "VALUES ($1, $2, $3) RETURNING id"
+        )
+    conn.commit()
+
+
+# Per-thread scratch arrays so uniform-size scans reuse allocations
+# across calls; cv2 ops write into them via dst=.
+_scratch = threading.local()
 
 
-def preprocess_image(img_path: str) -> Optional[Image.Image]:
+def _scratch_buf(name: str, shape) -> np.ndarray:
+    buf = getattr(_scratch, name, None)
+    if buf is None or buf.shape != shape:
+        buf = np.empty(shape, dtype=np.uint8)
+        setattr(_scratch, name, buf)
+    return buf
+
+
+def preprocess_image(img_path: str) -> Optional[np.ndarray]:
+    """Read + binarize one scan.
+
+    The returned array is a per-thread scratch buffer, valid only until
+    the next preprocess_image call on the same thread; callers that hold
+    on to the result must copy it first.
+    """
     try:
         image = cv2.imread(img_path)
         if image is None:
             return None
-        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-        gray = cv2.bilateralFilter(gray, d=11, sigmaColor=17, sigmaSpace=17)
-        thr = cv2.adaptiveThreshold(
-            gray, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C,
-            cv2.THRESH_BINARY, 31, 2
-        )
-        thr = cv2.resize(thr, None, fx=1.25, fy=1.25, interpolation=cv2.INTER_CUBIC)
-        return Image.fromarray(thr)
+        shape = image.shape[:2]
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY, dst=_scratch_buf("gray", shape))
+        # Median blur is O(W*H) and SIMD-vectorized; the bilateral filter is
+        # O(W*H*d^2) and dominated preprocessing time. adaptiveThreshold
+        # already denoises locally, so keep bilateral only as an opt-in.
+        blur = _scratch_buf("blur", shape)
+        if os.getenv("OCR_DENOISE", "median") == "bilateral":
+            gray = cv2.bilateralFilter(gray, d=5, sigmaColor=25, sigmaSpace=25, dst=blur)
+        else:
+            gray = cv2.medianBlur(gray, 3, dst=blur)
+        # Upscale before thresholding: resizing 1-channel uint8 is cheaper
+        # than resizing the binary output and preserves more OCR signal.
+        # Only small scans need it (tesseract rescales to ~300 DPI anyway),
+        # and bilinear taps half the pixels bicubic does.
+        h, w = gray.shape
+        if min(h, w) < 1000:
+            gray = cv2.resize(gray, None, fx=1.25, fy=1.25, interpolation=cv2.INTER_LINEAR)
+        # MEAN_C reduces to a single box-sum per pixel and is the SIMD-fast
+        # path in OpenCV; the 31x31 Gaussian variant stays as an opt-out
+        # via OCR_THRESH=gaussian if accuracy regresses on some scans.
+        thr = _scratch_buf("thr", gray.shape)
+        if os.getenv("OCR_THRESH", "mean") == "gaussian":
+            cv2.adaptiveThreshold(
+                gray, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C,
+                cv2.THRESH_BINARY, 31, 2, dst=thr
+            )
+        else:
+            cv2.adaptiveThreshold(
+                gray, 255, cv2.ADAPTIVE_THRESH_MEAN_C,
+                cv2.THRESH_BINARY, 15, 10, dst=thr
+            )
+        return thr
     except Exception:
         traceback.print_exc()
         return None
 
 
-def ocr_image(pil_img: Image.Image) -> str:
-    config = r'--oem 1 --psm 6'
-    text = pytesseract.image_to_string(pil_img, config=config)
+def ocr_image(img: np.ndarray) -> str:
+    # BMP encode is a raw copy plus header, and piping it to tesseract's
+    # stdin skips the temp-file dance pytesseract does. Set
+    # OCR_BACKEND=pytesseract to go through the library instead.
+    if os.getenv("OCR_BACKEND", "stdin") == "pytesseract":
+        text = pytesseract.image_to_string(img, config=r'--oem 1 --psm 6')
+    else:
+        proc = subprocess.run(
+            [pytesseract.pytesseract.tesseract_cmd, "stdin", "stdout",
+             "--oem", "1", "--psm", "6"],
+            input=cv2.imencode('.bmp', img)[1].tobytes(),
+            capture_output=True, check=True,
+        )
+        text = proc.stdout.decode("utf-8", errors="replace")
     return '\n'.join(line.strip() for line in text.splitlines() if line.strip())
 
 
+# How many preprocessed images to feed tesseract per invocation; bounds the
+# temp-file footprint while still amortizing process startup + model load.
+OCR_BATCH_SIZE = 64
+
+
+def ocr_batch(entries: List[Tuple[str, str]]) -> List[str]:
+    """OCR many preprocessed image files with a single tesseract invocation.
+
+    Takes (original path, preprocessed PNG path) pairs already on disk.
+    Tesseract accepts a text file listing one image path per line and
+    emits the pages on stdout separated by form-feeds, so one subprocess
+    covers the whole batch instead of one fork per image.
+    """
+    with tempfile.TemporaryDirectory() as tmpdir:
+        list_txt = os.path.join(tmpdir, "list.txt")
+        with open(list_txt, "w") as f:
+            f.write("\n".join(p for _, p in entries) + "\n")
+        proc = subprocess.run(
+            [pytesseract.pytesseract.tesseract_cmd, list_txt, "stdout",
+             "--oem", "1", "--psm", "6"],
+            capture_output=True, check=True,
+        )
+    pages = proc.stdout.decode("utf-8", errors="replace").split("\x0c")
+    return [
+        '\n'.join(line.strip() for line in page.splitlines() if line.strip())
+        for page in pages[:len(entries)]
+    ]
+
+
 def parse_fields(raw_text: str) -> Dict:
     fields: Dict[str, object] = {}
 
-    kv_pattern = re.compile(r'^\s*([A-Za-z0-9 _\-/\.]+)\s*[:=]\s*(.+?)\s*$', re.M)
-    for m in kv_pattern.finditer(raw_text):
+    for m in _KV_RE.finditer(raw_text):
         key = m.group(1).strip().lower()
         key = key.replace(' ', '_').replace('-', '_').replace('/', '_').replace('.', '_')
-        key = re.sub(r'[^a-z0-9_]+', '', key)[:64]
+        key = _KEY_CLEAN.sub('', key)[:64]
         val = m.group(2).strip()
         if key:
             fields[key] = val
 
-    emails = re.findall(r'[A-Za-z0-9._%+\-]+@[A-Za-z0-9.\-]+\.[A-Za-z]{2,}', raw_text)
+    emails = []
+    phones = []
+    for m in _CONTACT_RE.finditer(raw_text):
+        if m.lastgroup == 'email':
+            emails.append(m.group('email'))
+        else:
+            phones.append(m.group('phone'))
+
     if emails:
         fields['emails'] = list(dict.fromkeys(emails))
 
-    phones = re.findall(r'(?:\+?\d{1,3}[\s\-\.]?)?(?:\(?\d{2,4}\)?[\s\-\.]?)?\d{3,4}[\s\-\.]?\d{4}', raw_text)
-    clean_phones = [p.strip() for p in phones if len(re.sub(r'\D', '', p)) >= 8]
+    clean_phones = [p.strip() for p in phones if len(_NONDIGIT.sub('', p)) >= 8]
     if clean_phones:
         fields['phones'] = list(dict.fromkeys(clean_phones))
 
@@ -105,34 +234,154 @@ def parse_fields(raw_text: str) -> Dict:
 
 
 def insert_document(conn, filename: str, raw_text: str, fields: Dict):
+    with conn.cursor() as cur:
+        cur.execute("EXECUTE ocr_ins (%s, %s, %s)", (filename, raw_text, Json(fields)))
+        new_id = cur.fetchone()[0]
+    conn.commit()
+    return new_id
+
+
+# Rows per INSERT round trip; one transaction per chunk.
+DB_BATCH_SIZE = 50
+
+
+def insert_documents(conn, rows: List[Tuple[str, str, Dict]]) -> List[int]:
+    """Insert many OCR rows with one round trip per chunk; returns new ids."""
     sql = '''
     INSERT INTO ocr_documents (filename, raw_text, fields)
-    VALUES (%s, %s, %s)
+    VALUES %s
     RETURNING id;
     '''
+    ids: List[int] = []
     with conn.cursor() as cur:
-        cur.execute(sql, (filename, raw_text, Json(fields)))
-        new_id = cur.fetchone()[0]
-        return new_id
+        for i in range(0, len(rows), DB_BATCH_SIZE):
+            chunk = [(f, t, Json(d)) for f, t, d in rows[i:i + DB_BATCH_SIZE]]
+            execute_values(cur, sql, chunk)
+            ids.extend(r[0] for r in cur.fetchall())
+            conn.commit()
+    return ids
 
 
-def process_image_path(conn, path: str):
-    pil_img = preprocess_image(path)
-    if pil_img is None:
-        print(f"[WARN] Could not read image: {path}")
-        return
+def _worker_init():
+    # Each worker is a fresh process; re-apply the tesseract path from .env.
+    load_dotenv()
+    tess_path = os.getenv("TESSERACT_PATH", "").strip()
+    if tess_path:
+        pytesseract.pytesseract.tesseract_cmd = tess_path
+    # One cv2 thread per worker: the pool already saturates the cores, and
+    # OpenCV's own pool on top of that just oversubscribes.
+    cv2.setUseOptimized(True)
+    cv2.setNumThreads(1)
 
-    text = ocr_image(pil_img)
-    if not text.strip():
-        print(f"[WARN] No text detected: {path}")
-        return
 
-    fields = parse_fields(text)
-    new_id = insert_document(conn, os.path.basename(path), text, fields)
-    print(f"[OK] Saved OCR (id={new_id}) for: {path}")
-    if fields:
-        print("     Parsed fields:")
-        print(json.dumps(fields, ensure_ascii=False, indent=2))
+def _preprocess_worker(tmpdir: str, path: str) -> Optional[Tuple[str, str]]:
+    """Preprocess one image to a PNG under tmpdir; no DB handle, no OCR.
+
+    Handing the batch stage a file path instead of the pixels keeps only
+    one scan's pixels in memory at a time — tesseract needs the files on
+    disk anyway — and sidesteps copying out of the scratch buffer.
+    """
+    try:
+        img = preprocess_image(path)
+        if img is None:
+            print(f"[WARN] Could not read image: {path}")
+            return None
+        fd, png_path = tempfile.mkstemp(suffix=".png", dir=tmpdir)
+        os.close(fd)
+        if not cv2.imwrite(png_path, img):
+            os.unlink(png_path)
+            print(f"[ERROR] Failed to write preprocessed image for: {path}")
+            return None
+        return (path, png_path)
+    except Exception:
+        print(f"[ERROR] Failed to preprocess: {path}")
+        traceback.print_exc()
+        return None
+
+
+def _ocr_chunk_worker(paths: List[str]) -> List[Tuple[str, str]]:
+    """Preprocess + batch-OCR one chunk of files; returns (path, text) pairs.
+
+    Runs in a worker with no DB handle, so both stages parallelize across
+    chunks while the parent only ever holds OCR'd text.
+    """
+    if len(paths) == 1:
+        # A lone image doesn't need the list-file machinery; OCR it
+        # straight from memory via the stdin path.
+        path = paths[0]
+        try:
+            img = preprocess_image(path)
+            if img is None:
+                print(f"[WARN] Could not read image: {path}")
+                return []
+            return [(path, ocr_image(img))]
+        except Exception:
+            print(f"[ERROR] Failed to process: {path}")
+            traceback.print_exc()
+            return []
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        entries = []
+        for path in paths:
+            res = _preprocess_worker(tmpdir, path)
+            if res is not None:
+                entries.append(res)
+        if not entries:
+            return []
+        try:
+            texts = ocr_batch(entries)
+        except Exception:
+            # One bad image can sink the whole tesseract batch; retry each
+            # file individually so the rest of the chunk still lands.
+            print(f"[ERROR] OCR batch of {len(entries)} images failed; "
+                  "retrying images individually")
+            traceback.print_exc()
+            texts = []
+            for path, png_path in entries:
+                try:
+                    img = cv2.imread(png_path, cv2.IMREAD_GRAYSCALE)
+                    texts.append(ocr_image(img) if img is not None else "")
+                except Exception:
+                    print(f"[ERROR] OCR failed for: {path}")
+                    traceback.print_exc()
+                    texts.append("")
+    return [(path, text) for (path, _), text in zip(entries, texts)]
+
+
+def _flush_batch(conn, results: List[Tuple[str, str]]):
+    docs = []
+    for path, text in results:
+        if not text.strip():
+            print(f"[WARN] No text detected: {path}")
+            continue
+        try:
+            docs.append((path, text, parse_fields(text)))
+        except Exception:
+            print(f"[ERROR] Failed to parse: {path}")
+            traceback.print_exc()
+    if not docs:
+        return
+    try:
+        if len(docs) == 1:
+            # Singleton flushes (single-image runs, tail batches) ride the
+            # prepared statement instead of execute_values.
+            path, text, fields = docs[0]
+            ids = [insert_document(conn, os.path.basename(path), text, fields)]
+        else:
+            ids = insert_documents(
+                conn, [(os.path.basename(p), t, f) for p, t, f in docs]
+            )
+    except Exception:
+        # Roll back so the aborted transaction doesn't poison later batches.
+        print(f"[ERROR] Failed to insert batch of {len(docs)} documents")
+        traceback.print_exc()
+        conn.rollback()
+        return
+    for new_id, (path, _, fields) in zip(ids, docs):
+        print(f"[OK] Saved OCR (id={new_id}) for: {path}")
+        if fields:
+            print("     Parsed fields:")
+            print(_dumps(fields))
 
 
 def main():
@@ -157,15 +406,12 @@ def main():
     input_paths = []
     for arg in sys.argv[1:]:
         if os.path.isdir(arg):
-            input_paths.extend(
-                glob.glob(os.path.join(arg, "**", "*.png"), recursive=True) +
-                glob.glob(os.path.join(arg, "**", "*.jpg"), recursive=True) +
-                glob.glob(os.path.join(arg, "**", "*.jpeg"), recursive=True) +
-                glob.glob(os.path.join(arg, "**", "*.tif"), recursive=True) +
-                glob.glob(os.path.join(arg, "**", "*.tiff"), recursive=True) +
-                glob.glob(os.path.join(arg, "**", "*.bmp"), recursive=True) +
-                glob.glob(os.path.join(arg, "**", "*.webp"), recursive=True)
-            )
+            # One walk filtered by extension instead of seven recursive globs.
+            for root, _, files in os.walk(arg):
+                input_paths.extend(
+                    os.path.join(root, f) for f in files
+                    if os.path.splitext(f)[1].lower() in IMAGE_EXTS
+                )
         else:
             input_paths.append(arg)
 
@@ -173,13 +419,24 @@ def main():
         print("[INFO] No images found to process.")
         return
 
-    for p in input_paths:
-        try:
-            process_image_path(conn, p)
-        except Exception:
-            print(f"[ERROR] Failed to process: {p}")
-            traceback.print_exc()
+    # Each worker preprocesses and batch-OCRs a whole chunk, so both
+    # stages scale with the core count; only the psycopg2 inserts stay
+    # here. OCR_MULTIPROCESS=0 keeps everything in this process and lets
+    # OpenCV's internal parallel paths use every core instead.
+    cv2.setUseOptimized(True)
+    chunks = [
+        input_paths[i:i + OCR_BATCH_SIZE]
+        for i in range(0, len(input_paths), OCR_BATCH_SIZE)
+    ]
+    if os.getenv("OCR_MULTIPROCESS", "1") != "0":
+        with ProcessPoolExecutor(max_workers=os.cpu_count(), initializer=_worker_init) as ex:
+            for results in ex.map(_ocr_chunk_worker, chunks):
+                _flush_batch(conn, results)
+    else:
+        cv2.setNumThreads(os.cpu_count())
+        for results in map(_ocr_chunk_worker, chunks):
+            _flush_batch(conn, results)
 
 
 if __name__ == "__main__":
-    main()
+    main()
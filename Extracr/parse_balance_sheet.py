@@ -1,32 +1,99 @@
+import io
 import os
-import re
+import sys
 import json
 import psycopg2
 from psycopg2.extras import Json
 from dotenv import load_dotenv
 from typing import List, Dict, Optional, Tuple
 
+# All patterns in this module are linear-time (no backrefs/lookaround);
+# use RE2's DFA when installed, stdlib re otherwise.
+try:
+    import re2 as re
+except ImportError:
+    import re
+
+# orjson serializes in C; stdlib json is the fallback.
+try:
+    import orjson
+
+    def _dumps(obj) -> str:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2).decode()
+except ImportError:
+    def _dumps(obj) -> str:
+        return json.dumps(obj, indent=2, ensure_ascii=False)
+
 # ---------- helpers ----------
 
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+try:
+    import pandas as pd
+except ImportError:
+    pd = None
+
+# Delete-table for everything except digits, comma, dot, sign; one
+# C-level pass instead of a regex sub per cell.
+_NUM_KEEP = str.maketrans(
+    "", "", "".join(chr(c) for c in range(256) if chr(c) not in "0123456789,.-")
+)
+_NUMS_RE = re.compile(r"[-+]?\d[\d,.\-]*")
+# Strips the last two numeric tokens (and trailing whitespace) in one sub.
+_TRAIL_NUMS = re.compile(r"(?:[-+]?\d[\d,.\-]*\s*){1,2}$")
+_HEADER_RE = re.compile(r"^\s*(assets|equity|liabilities|notes|net assets value)", re.I)
+_WS = re.compile(r"\s+")
+
+if njit is not None:
+    @njit(cache=True)
+    def _parse_int(buf: bytes):
+        """Accumulate an integer from a cleaned digit token; (ok, value)."""
+        val = 0
+        neg = False
+        seen_digit = False
+        for i in range(len(buf)):
+            b = buf[i]
+            if 48 <= b <= 57:  # '0'-'9'
+                val = val * 10 + (b - 48)
+                seen_digit = True
+            elif b == 45 and i == 0:  # leading '-'
+                neg = True
+            else:
+                return False, 0
+        if not seen_digit:
+            return False, 0
+        return True, -val if neg else val
+else:
+    _parse_int = None
+
+
 def num_clean(s: str) -> Optional[int]:
     """Convert OCR number strings like '1,342,700', '3.900.07', '15,773' -> int."""
     if not s:
         return None
-    s = s.strip()
-    s = re.sub(r"[^0-9,.\-]", "", s)  # keep digits, comma, dot, sign
-
-    if "," in s and "." in s:
-        s = s.replace(",", "")
-    elif "," in s and "." not in s:
-        s = s.replace(",", "")
+    s = s.translate(_NUM_KEEP)  # keep digits, comma, dot, sign
+    s = s.replace(",", "")
 
     if s.count(".") > 1:
         s = s.replace(".", "")
 
+    if "." not in s:
+        # Integers are the common case; the JIT-compiled accumulator skips
+        # interpreter overhead entirely when numba is installed.
+        if _parse_int is not None:
+            ok, val = _parse_int(s.encode("ascii", "ignore"))
+            if ok:
+                return val
+        try:
+            return int(s)
+        except ValueError:
+            return None
     try:
-        val = float(s)
-        return int(round(val))
-    except Exception:
+        return int(round(float(s)))
+    except ValueError:
         return None
 
 
@@ -80,50 +147,115 @@ _FIXES = [
     (r"\brou ?asset\b", "right-of-use (rou) asset"),
 ]
 
-def clean_label(text: str) -> str:
-    t = text.lower().strip(" :\t-—_.")
-    t = re.sub(r"\s+", " ", t)
-    for pat, rep in _FIXES:
-        t = re.sub(pat, rep, t)
-    t = t.strip(" :\t-—_.")
+_FIXES_COMPILED = [(re.compile(p), r) for p, r in _FIXES]
+
+# Canonical-label lookup: a single Aho-Corasick scan replaces ~36 substring
+# searches per label when pyahocorasick is installed.
+try:
+    import ahocorasick
+
+    _AC = ahocorasick.Automaton()
+    for _k, _v in _CANON_MAP.items():
+        _AC.add_word(_k, (_k, _v))
+    _AC.make_automaton()
+except ImportError:
+    _AC = None
+
+
+def _canonicalize(t: str) -> Optional[str]:
+    if _AC is not None:
+        for _, (_key, canon) in _AC.iter(t):
+            return canon  # first hit wins
+        return None
     for key in _CANON_MAP:
         if key in t:
             return _CANON_MAP[key]
-    return t
+    return None
 
-def extract_two_years_from_line(line: str) -> Optional[Tuple[int, int, str]]:
-    """Take a line, extract last two numeric tokens as (2022, 2021), return with label."""
+
+def clean_label(text: str) -> str:
+    t = text.lower().strip(" :\t-—_.")
+    t = _WS.sub(" ", t)
+    for pat, rep in _FIXES_COMPILED:
+        t = pat.sub(rep, t)
+    t = t.strip(" :\t-—_.")
+    canon = _canonicalize(t)
+    return canon if canon is not None else t
+
+def _extract_row_tokens(line: str) -> Optional[Tuple[str, str, str]]:
+    """Split a line into (label, 2022 token, 2021 token) without parsing the numbers."""
     s = line.strip()
     if not s:
         return None
-    if re.search(r"^\s*(assets|equity|liabilities|notes|net assets value)", s, re.I):
+    # Two 2+-digit values means at least 4 digits; rejecting headers,
+    # blanks and label-only rows here skips the regex engine entirely.
+    if sum(c.isdigit() for c in s) < 4:
+        return None
+    if _HEADER_RE.search(s):
         return None
 
-    nums = re.findall(r"[-+]?\d[\d,.\-]*", s)
+    nums = _NUMS_RE.findall(s)
     if len(nums) < 2:
         return None
 
-    v2022 = num_clean(nums[-2])
-    v2021 = num_clean(nums[-1])
-
-    label_part = re.sub(r"[-+]?\d[\d,.\-]*\s*$", "", s)            # drop last number
-    label_part = re.sub(r"[-+]?\d[\d,.\-]*\s*$", "", label_part)   # drop second last
+    label_part = _TRAIL_NUMS.sub("", s)  # drop the last two numbers
     label = clean_label(label_part)
-
     if not label:
         return None
+    return (label, nums[-2], nums[-1])
+
+def extract_two_years_from_line(line: str) -> Optional[Tuple[int, int, str]]:
+    """Take a line, extract last two numeric tokens as (2022, 2021), return with label."""
+    toks = _extract_row_tokens(line)
+    if not toks:
+        return None
+    label, t2022, t2021 = toks
+    v2022 = num_clean(t2022)
+    v2021 = num_clean(t2021)
     if v2022 is None and v2021 is None:
         return None
     return (v2022, v2021, label)
 
+# Below this many tokens the pandas setup cost outweighs the vectorized parse.
+_VECTOR_MIN = 64
+
+def _num_clean_batch(tokens: List[str]) -> List[Optional[int]]:
+    """num_clean over a whole column at once; pandas runs the character
+    filtering in vectorized C when the batch is big enough."""
+    if pd is None or len(tokens) < _VECTOR_MIN:
+        return [num_clean(t) for t in tokens]
+    ser = pd.Series(tokens, dtype="object").str.replace(r"[^0-9.\-]", "", regex=True)
+    multi_dot = ser.str.count(r"\.") > 1
+    if multi_dot.any():
+        ser[multi_dot] = ser[multi_dot].str.replace(".", "", regex=False)
+    vals = pd.to_numeric(ser, errors="coerce").round()
+    return [None if pd.isna(v) else int(v) for v in vals]
+
 def parse_balance_sheet_text(raw_text: str) -> Dict:
+    # Pass 1: tokenize lines; pass 2: parse all numbers as two columns so
+    # the batch path can vectorize, then assemble/dedupe rows.
+    labels: List[str] = []
+    toks_2022: List[str] = []
+    toks_2021: List[str] = []
+    # Iterate lazily instead of materializing every line with splitlines();
+    # keeps peak memory flat on multi-MB OCR dumps.
+    for raw_line in io.StringIO(raw_text):
+        toks = _extract_row_tokens(raw_line.rstrip("\n"))
+        if not toks:
+            continue
+        label, t2022, t2021 = toks
+        labels.append(label)
+        toks_2022.append(t2022)
+        toks_2021.append(t2021)
+
+    vals_2022 = _num_clean_batch(toks_2022)
+    vals_2021 = _num_clean_batch(toks_2021)
+
     rows: List[Dict] = []
     seen = set()
-    for raw_line in raw_text.splitlines():
-        res = extract_two_years_from_line(raw_line)
-        if not res:
+    for label, v2022, v2021 in zip(labels, vals_2022, vals_2021):
+        if v2022 is None and v2021 is None:
             continue
-        v2022, v2021, label = res
         if label in seen:
             continue
         seen.add(label)
@@ -154,6 +286,14 @@ def fetch_latest_ocr_row(conn, row_id: Optional[int] = None):
         cur.execute(sql, params)
         return cur.fetchone()
 
+def iter_ocr_rows(conn, batch: int = 500):
+    """Stream every OCR row via a server-side cursor; rows arrive in chunks
+    of `batch` instead of materializing the whole table client-side."""
+    with conn.cursor(name="ocr_stream") as cur:
+        cur.itersize = batch
+        cur.execute("SELECT id, filename, raw_text, fields FROM ocr_documents ORDER BY id")
+        yield from cur
+
 def upsert_balance_sheet(conn, row_id: int, balance_sheet: Dict):
     with conn.cursor() as cur:
         cur.execute(
@@ -169,6 +309,18 @@ def upsert_balance_sheet(conn, row_id: int, balance_sheet: Dict):
 
 def main():
     conn = get_conn_from_env()
+
+    if "--all" in sys.argv[1:]:
+        # Backfill: stream the whole archive and upsert inside one
+        # transaction (the named cursor needs one open anyway).
+        count = 0
+        for _id, filename, raw_text, _fields in iter_ocr_rows(conn):
+            upsert_balance_sheet(conn, _id, parse_balance_sheet_text(raw_text))
+            count += 1
+        conn.commit()
+        print(f"[OK] Updated fields.balance_sheet for {count} rows")
+        return
+
     conn.autocommit = True
 
     row = fetch_latest_ocr_row(conn, row_id=None)  # put a specific id if needed
@@ -181,7 +333,7 @@ def main():
 
     parsed = parse_balance_sheet_text(raw_text)
 
-    print(json.dumps(parsed, indent=2, ensure_ascii=False))
+    print(_dumps(parsed))
 
     upsert_balance_sheet(conn, _id, parsed)
     print(f"[OK] Updated fields.balance_sheet for id={_id}")